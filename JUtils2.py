@@ -7,8 +7,47 @@ import time
 import traceback
 import shlex
 import sys
+import asyncio
+import collections.abc
+import concurrent.futures
+import io
+import json
+import threading
 
-storedVariables = {}
+# Holds the variables and output stream of the CommandSession running on the current thread, if any.
+sessionContext = threading.local()
+
+class StoredVariables(collections.abc.MutableMapping):
+    """A dictionary of the variables used by commands. Code running inside a CommandSession sees that session's variables, everything else sees one shared set."""
+    def __init__(self):
+        self.shared = {}
+
+    def getVariables(self):
+        """Returns the dictionary backing the variables on the current thread."""
+        return getattr(sessionContext, "variables", self.shared)
+
+    def __getitem__(self, key):
+        return self.getVariables()[key]
+
+    def __setitem__(self, key, value):
+        self.getVariables()[key] = value
+
+    def __delitem__(self, key):
+        del self.getVariables()[key]
+
+    def __iter__(self):
+        return iter(self.getVariables())
+
+    def __len__(self):
+        return len(self.getVariables())
+
+    def clear(self):
+        self.getVariables().clear()
+
+    def __repr__(self):
+        return "StoredVariables(%s)" % self.getVariables()
+
+storedVariables = StoredVariables()
 
 class Compatibility():
     """Provides simple methods to aid with compatibility."""
@@ -215,7 +254,7 @@ class CommandProcessor2():
 
     def forceQueueCommands(self, commands):
         """Does the same thing as queueCommands, but forces the inputted commands to the front of the queue."""
-        self.queue = AdvancedMap(commands).selectivelyMapResults(lambda x: type(x) is str, lambda x: Utilities.parseCommand(x)) + self.queue
+        self.queue = AdvancedMap(commands).selectivelyMapResults(lambda x: type(x) is str, lambda x: Utilities.parseCommand(x)).getResults() + self.queue
 
     def executeNextInQueue(self):
         """Execute stored commands."""
@@ -560,10 +599,8 @@ class WaitCommand():
         return "wait"
 
     def execute(self, args):
-        start = Utilities.getSystemTime()
-        time = 1000 if len(args) == 0 else Utilities.tryParse(args[0], 1000)
-        while start + time > Utilities.getSystemTime():
-            pass
+        delay = 1000 if len(args) == 0 else Utilities.tryParse(args[0], 1000)
+        time.sleep(max(delay, 0) / 1000)
 
     def getMinimumArguments(self):
         return 0
@@ -655,17 +692,404 @@ class ExitCommand():
     def isEnabled(self):
         return True
 
+def getDefaultCommands(processor):
+    """Returns a list of the standard commands, bound to 'processor' where a command needs one."""
+    return [JUtilsCommand(), HelpCommand(processor), RunScriptCommand(processor), DefineCommand(), DefineIntCommand(), CompareCommand(), AddCommand(), PrintCommand(), ConditionalCommand(processor), WaitCommand(), VariablesCommand(), ClearMemoryCommand(), ExitCommand()]
+
 def runTerminal(header = "", commands = []):
-    global storedVariables
-    storedVariables = {}
+    storedVariables.clear()
     processor = CommandProcessor2()
     print(header)
-    processor.registerCommands([JUtilsCommand(), HelpCommand(processor), RunScriptCommand(processor), DefineCommand(), DefineIntCommand(), CompareCommand(), AddCommand(), PrintCommand(), ConditionalCommand(processor), WaitCommand(), VariablesCommand(), ClearMemoryCommand(), ExitCommand()] + commands)
+    processor.registerCommands(getDefaultCommands(processor) + commands)
     while True:
         parsedCommand = Utilities.getParsedInput("> ")
         processor.executeCommand(parsedCommand[0], parsedCommand[1])
         while processor.executeNextInQueue():
             pass
 
+# === Socket Server === #
+class SessionOutput():
+    """Stands in for sys.stdout. Writes made while a CommandSession is running on the current thread go to that session, everything else goes to the original stream."""
+    lock = threading.Lock()
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def install():
+        """Wraps sys.stdout in a SessionOutput unless it is one already."""
+        with SessionOutput.lock:
+            if not isinstance(sys.stdout, SessionOutput):
+                sys.stdout = SessionOutput(sys.stdout)
+
+    def getStream(self):
+        """Returns the stream writes on the current thread should go to."""
+        output = getattr(sessionContext, "output", None)
+        return self.stream if output is None else output
+
+    def write(self, data):
+        return self.getStream().write(data)
+
+    def flush(self):
+        return self.getStream().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class CommandSession():
+    """A single client's session: a CommandProcessor2 with the standard commands registered, and its own stored variables.\n'commands' is either a list of extra commands, or a function that takes the session's processor and returns one, like getDefaultCommands."""
+    def __init__(self, commands = []):
+        self.processor = CommandProcessor2({})
+        self.variables = {}
+        self.processor.registerCommands(getDefaultCommands(self.processor) + (commands(self.processor) if callable(commands) else commands))
+        SessionOutput.install()
+
+    def reset(self):
+        """Clears the session's stored variables and command queue so it can be handed to another client."""
+        self.variables = {}
+        self.processor.clearCommandQueue()
+
+    def executeLine(self, line, timeLimit = None):
+        """Executes a line of input, along with anything it queues, and returns a tuple of (status, output).\nThe status is "ok", "error" if the line could not be parsed or a command raised an exception, "exit" if a command asked to close the session, or "timeout" if queued commands were still running after 'timeLimit' seconds.\nThe time limit is checked between queued commands, so a single command that never returns is not interrupted."""
+        deadline = None if timeLimit is None else time.monotonic() + timeLimit
+        output = io.StringIO()
+        status = "ok"
+        sessionContext.variables = self.variables
+        sessionContext.output = output
+        try:
+            parsedCommand = Utilities.parseCommand(line)
+            if len(parsedCommand[0]) > 0:
+                self.processor.executeCommand(parsedCommand[0], parsedCommand[1])
+                while self.processor.executeNextInQueue():
+                    if deadline is not None and time.monotonic() > deadline:
+                        self.processor.clearCommandQueue()
+                        status = "timeout"
+                        output.write(f"The request did not finish within {timeLimit} seconds.\n")
+        except SystemExit:
+            status = "exit"
+        except Exception:
+            status = "error"
+            output.write(traceback.format_exc(limit = 0))
+            self.processor.clearCommandQueue()
+        finally:
+            del sessionContext.variables
+            del sessionContext.output
+        return (status, output.getvalue())
+
+    def executeLines(self, lines, timeLimit = None, sliceTime = None):
+        """Executes lines in order and returns a list of (status, output) tuples for the ones that ran.\nExecution stops after a line with the "exit" status, or before starting a new line once 'sliceTime' seconds have passed. At least one line is always run."""
+        start = time.monotonic()
+        results = []
+        for line in lines:
+            if len(results) > 0 and sliceTime is not None and time.monotonic() - start > sliceTime:
+                break
+            results.append(self.executeLine(line, timeLimit))
+            if results[-1][0] == "exit":
+                break
+        return results
+
+class SessionPool():
+    """Hands out CommandSession objects to connections, keeping up to 'maximumIdle' released sessions around for reuse."""
+    def __init__(self, commands = [], maximumIdle = 16):
+        self.commands = commands
+        self.maximumIdle = maximumIdle
+        self.idle = []
+
+    def acquire(self):
+        """Returns an idle session, or a new one if none are idle."""
+        return self.idle.pop() if len(self.idle) > 0 else CommandSession(self.commands)
+
+    def release(self, session):
+        """Resets a session and returns it to the pool."""
+        session.reset()
+        if len(self.idle) < self.maximumIdle:
+            self.idle.append(session)
+
+class CommandServer():
+    """Serves command sessions to many clients at once over TCP or a Unix socket.\nEach request is one line of input as it would be typed into the terminal, and each response is one line of JSON: {"status": ..., "output": ...}.\nRequests may be pipelined, and responses are always sent in the order the requests were received. A request longer than 'lineLimit' bytes is answered with an error and the connection is closed, and a response that would be longer than 'responseLimit' bytes is replaced with an error. The last response sent before the server closes a connection also carries "closing": true. Once 'pipelineDepth' requests on a connection have been read but not yet answered, the server stops reading from it, leaving further requests in the socket buffers and the stream's own buffer of up to twice 'lineLimit' bytes.\nRequests from different connections run at the same time on up to 'maximumWorkers' threads. Each connection runs its queued requests in order, giving up its thread after 'sliceTime' seconds so connections take turns. A request still running 'requestTimeLimit' seconds after it started gets the "timeout" status. If its command has not returned a second after that, the connection is closed and its session is abandoned. Time spent waiting for a free worker thread does not count towards the limit.\n'commands' is either a function that takes a session's processor and returns that session's extra commands, like getDefaultCommands, or a list of commands. Commands in a list are shared by every session and run on several threads at once, so they must be stateless and thread-safe.\nA command that never returns keeps its worker thread busy for good, and commands share the interpreter lock, so CPU-heavy commands still slow down every other connection."""
+    def __init__(self, commands = [], pipelineDepth = 64, lineLimit = 65536, responseLimit = 1048576, maximumIdleSessions = 16, maximumWorkers = 8, requestTimeLimit = 30, sliceTime = 0.005):
+        self.sessions = SessionPool(commands, maximumIdleSessions)
+        self.pipelineDepth = pipelineDepth
+        self.lineLimit = lineLimit
+        self.responseLimit = responseLimit
+        self.requestTimeLimit = requestTimeLimit
+        self.sliceTime = sliceTime
+        self.requestsServed = 0
+        self.connections = {}
+        self.executions = {}
+        self.server = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = maximumWorkers)
+
+    async def start(self, host = "127.0.0.1", port = 0, path = None):
+        """Starts listening on 'host' and 'port', or on the Unix socket at 'path' if one is given. A port of 0 picks a free port."""
+        if path is None:
+            self.server = await asyncio.start_server(self.handleConnection, host, port, limit = self.lineLimit)
+        else:
+            self.server = await asyncio.start_unix_server(self.handleConnection, path, limit = self.lineLimit)
+        return self
+
+    def getAddress(self):
+        """Returns the address the server is listening on, either a (host, port) tuple or a socket path."""
+        return self.server.sockets[0].getsockname()
+
+    async def serveForever(self):
+        """Serves clients until the server is closed."""
+        await self.server.serve_forever()
+
+    async def close(self):
+        """Stops accepting clients and closes all open connections."""
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections.values()):
+                writer.close()
+            await asyncio.gather(*self.connections.keys(), return_exceptions = True)
+            await self.server.wait_closed()
+        self.executor.shutdown(wait = False)
+
+    async def handleConnection(self, reader, writer):
+        """Serves a single client connection until it disconnects or exits."""
+        connection = asyncio.current_task()
+        self.connections[connection] = writer
+        session = self.sessions.acquire()
+        requests = asyncio.Queue()
+        slots = asyncio.Semaphore(self.pipelineDepth)
+        readTask = asyncio.create_task(self.__readRequests(reader, requests, slots))
+        reusable = True
+        try:
+            reusable = await self.__processRequests(session, requests, slots, writer)
+        except ConnectionError:
+            pass
+        finally:
+            readTask.cancel()
+            await asyncio.gather(readTask, return_exceptions = True)
+            # The handler can be cancelled while a worker thread is still using the session, in which case it is abandoned.
+            execution = self.executions.pop(connection, None)
+            if execution is not None:
+                execution.cancel()
+            if reusable and (execution is None or execution.done()):
+                self.sessions.release(session)
+            self.connections.pop(connection, None)
+            writer.close()
+
+    async def __readRequests(self, reader, requests, slots):
+        # Each request takes a slot until it is answered. Waiting for a free slot stops reads from the socket, which pushes back on the client.
+        while True:
+            await slots.acquire()
+            try:
+                line = await reader.readline()
+            except ValueError:
+                await requests.put(("error", f"Request exceeded the {self.lineLimit} byte line limit."))
+                return
+            except ConnectionError:
+                line = b""
+            if len(line) == 0:
+                await requests.put(None)
+                return
+            await requests.put(line.decode("utf-8", "replace").rstrip("\r\n"))
+
+    async def __processRequests(self, session, requests, slots, writer):
+        # Returns false if the session was abandoned with a command still running on it.
+        loop = asyncio.get_running_loop()
+        pending = []
+        while True:
+            if len(pending) == 0:
+                pending.append(await requests.get())
+            while not requests.empty():
+                pending.append(requests.get_nowait())
+
+            lines = []
+            for request in pending:
+                if type(request) is not str:
+                    break
+                lines.append(request)
+
+            reusable = True
+            if len(lines) == 0:
+                if pending[0] is None:
+                    return True
+                results = [pending[0]]
+            else:
+                started = loop.create_future()
+                self.executions[asyncio.current_task()] = self.executor.submit(self.__executeBatch, loop, started, session, lines)
+                execution = asyncio.wrap_future(self.executions[asyncio.current_task()])
+                # The time limit only applies once a worker thread has picked the batch up.
+                await asyncio.wait([started, execution], return_when = asyncio.FIRST_COMPLETED)
+                try:
+                    results = await asyncio.wait_for(execution, None if self.requestTimeLimit is None else self.requestTimeLimit + self.sliceTime + 1)
+                except asyncio.TimeoutError:
+                    results = [("timeout", f"The request did not finish within {self.requestTimeLimit} seconds. The connection has been closed.\n")]
+                    reusable = False
+            del pending[:len(results)]
+            self.requestsServed += len(results)
+
+            closing = len(lines) == 0 or results[-1][0] == "exit" or not reusable
+            writer.write(b"".join(AdvancedMap(results[:-1]).mapResults(lambda x: self.__encodeResponse(x))) + self.__encodeResponse(results[-1], closing))
+            await writer.drain()
+            for x in results:
+                slots.release()
+            if closing:
+                return reusable
+
+    def __executeBatch(self, loop, started, session, lines):
+        loop.call_soon_threadsafe(CommandServer.__markStarted, started)
+        return session.executeLines(lines, self.requestTimeLimit, self.sliceTime)
+
+    def __markStarted(started):
+        if not started.done():
+            started.set_result(None)
+
+    def __encodeResponse(self, result, closing = False):
+        response = {"status": result[0], "output": result[1]}
+        if closing:
+            response["closing"] = True
+        encoded = json.dumps(response, ensure_ascii = False).encode("utf-8")
+        if len(encoded) > self.responseLimit:
+            response["status"] = "error"
+            response["output"] = f"The response was {len(encoded)} bytes, over the {self.responseLimit} byte limit."
+            encoded = json.dumps(response).encode("utf-8")
+        return encoded + b"\n"
+
+class CommandClient():
+    """A connection to a CommandServer. Each connection has its own session, so variables defined over one connection are not visible from another."""
+    def __init__(self, reader, writer, responseLimit = 1048576):
+        self.reader = reader
+        self.writer = writer
+        self.responseLimit = responseLimit
+        self.lock = asyncio.Lock()
+
+    async def connect(host = "127.0.0.1", port = 8765, path = None, responseLimit = 1048576):
+        """Connects to a server at 'host' and 'port', or at the Unix socket 'path' if one is given, and returns a CommandClient.\n'responseLimit' should be at least the server's own response limit."""
+        if path is None:
+            reader, writer = await asyncio.open_connection(host, port, limit = responseLimit)
+        else:
+            reader, writer = await asyncio.open_unix_connection(path, limit = responseLimit)
+        return CommandClient(reader, writer, responseLimit)
+
+    async def executeCommand(self, line):
+        """Sends a single line of input and returns a tuple of (status, output)."""
+        return (await self.executeCommands([line]))[0]
+
+    async def executeCommands(self, lines, chunkSize = 256):
+        """Pipelines a list of lines to the server and returns a list of (status, output) tuples in the same order.\nLines are sent in chunks of 'chunkSize' while responses are read, so batches of any size can be sent.\nIf the server closes the connection partway through, for example after an "exit" request or an over-long line, the results already received are kept, every request left unanswered gets the "closed" status, and the client closes its side of the connection.\nA response longer than 'responseLimit' bytes gets the "error" status, and the connection is closed since the rest of the stream can no longer be read."""
+        if len(AdvancedMap(lines).filterResults(lambda x: "\n" in x or "\r" in x)) > 0:
+            raise ValueError("Requests cannot contain line breaks.")
+        async with self.lock:
+            sendTask = asyncio.create_task(self.__sendLines(lines, chunkSize))
+            results = []
+            try:
+                while len(results) < len(lines):
+                    try:
+                        response = await self.reader.readline()
+                    except ValueError:
+                        results.append(("error", f"The response was over the {self.responseLimit} byte limit."))
+                        self.writer.close()
+                        break
+                    except ConnectionError:
+                        response = b""
+                    if len(response) == 0:
+                        self.writer.close()
+                        break
+                    data = json.loads(response)
+                    results.append((data["status"], data["output"]))
+                    if data.get("closing", False):
+                        self.writer.close()
+                        break
+            finally:
+                sendTask.cancel()
+                await asyncio.gather(sendTask, return_exceptions = True)
+            return results + [("closed", "")] * (len(lines) - len(results))
+
+    async def __sendLines(self, lines, chunkSize):
+        # Runs alongside the reads in executeCommands, so the server is never left waiting on a client that is itself waiting to write.
+        try:
+            for x in range(0, len(lines), chunkSize):
+                self.writer.write("".join(AdvancedMap(lines[x:x + chunkSize]).mapResults(lambda y: y + "\n")).encode("utf-8"))
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+
+    def isClosed(self):
+        """Returns true if the connection has been closed by either side."""
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    async def close(self):
+        """Closes the connection."""
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+class CommandClientPool():
+    """Keeps up to 'maximumConnections' connections to a CommandServer open and shares them between callers.\nSince every connection is its own session, requests that depend on each other should be sent together with executeCommands."""
+    def __init__(self, host = "127.0.0.1", port = 8765, path = None, maximumConnections = 8):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.semaphore = asyncio.Semaphore(maximumConnections)
+        self.idle = []
+
+    async def acquire(self):
+        """Waits for a free connection and returns it, connecting if no idle connection is available."""
+        await self.semaphore.acquire()
+        try:
+            while len(self.idle) > 0:
+                client = self.idle.pop()
+                if not client.isClosed():
+                    return client
+            return await CommandClient.connect(self.host, self.port, self.path)
+        except:
+            self.semaphore.release()
+            raise
+
+    def release(self, client):
+        """Returns a connection to the pool. Closed connections are dropped."""
+        if not client.isClosed():
+            self.idle.append(client)
+        self.semaphore.release()
+
+    async def executeCommand(self, line):
+        """Sends a single line of input over a pooled connection and returns a tuple of (status, output)."""
+        return (await self.executeCommands([line]))[0]
+
+    async def executeCommands(self, lines):
+        """Pipelines a list of lines over a single pooled connection and returns a list of (status, output) tuples."""
+        client = await self.acquire()
+        try:
+            return await client.executeCommands(lines)
+        except:
+            await client.close()
+            raise
+        finally:
+            self.release(client)
+
+    async def close(self):
+        """Closes all idle connections."""
+        while len(self.idle) > 0:
+            await self.idle.pop().close()
+
+async def benchmarkServer(host = "127.0.0.1", port = 8765, path = None, command = "defint x 1", requests = 10000, connections = 8, pipelineDepth = 32):
+    """Sends 'command' to a server 'requests' times, spread over 'connections' connections in pipelined batches of 'pipelineDepth', and returns the requests per second."""
+    pool = CommandClientPool(host, port, path, connections)
+    batches = AdvancedMap(range(0, requests, pipelineDepth)).mapResults(lambda x: [command] * min(pipelineDepth, requests - x)).getResults()
+    start = time.perf_counter()
+    await asyncio.gather(*AdvancedMap(batches).mapResults(lambda x: pool.executeCommands(x)))
+    elapsed = time.perf_counter() - start
+    await pool.close()
+    return requests / elapsed
+
+def runServer(host = "127.0.0.1", port = 8765, path = None, commands = []):
+    """Serves the standard commands, plus 'commands', over TCP or a Unix socket until interrupted. 'commands' is passed on to CommandServer."""
+    async def serve():
+        server = await CommandServer(commands).start(host, port, path)
+        print("Serving on %s" % (server.getAddress(),))
+        try:
+            await server.serveForever()
+        finally:
+            await server.close()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
 if __name__ == "__main__":
     runTerminal("[JUtils2 v" + Compatibility.getVersionString() + "]\nCreated by Ryan Jones @ 2018\n\nUse the 'help' command for a detailed list of commands.\n")
@@ -0,0 +1,266 @@
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+import unittest
+
+import JUtils2
+
+class ProcessorCommand():
+    def __init__(self, processor):
+        self.processor = processor
+
+    def getName(self):
+        return "processor"
+
+    def execute(self, args):
+        print(id(self.processor))
+
+    def getMinimumArguments(self):
+        return 0
+
+    def getUsage(self):
+        return "processor"
+
+    def getShortDescription(self):
+        return "Prints the id of the processor the command was created for."
+
+    def getLongDescription(self):
+        return ["Prints the id of the processor the command was created for."]
+
+    def isEnabled(self):
+        return True
+
+class CommandServerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = await JUtils2.CommandServer(lineLimit = 4096, requestTimeLimit = 2).start()
+        self.host, self.port = self.server.getAddress()[:2]
+        self.clients = []
+
+    async def asyncTearDown(self):
+        for client in self.clients:
+            await client.close()
+        await self.server.close()
+        self.directory.cleanup()
+
+    async def connect(self, path = None):
+        client = await (JUtils2.CommandClient.connect(self.host, self.port) if path is None else JUtils2.CommandClient.connect(path = path))
+        self.clients.append(client)
+        return client
+
+    async def test_pipelinedRequestsAreAnsweredInOrder(self):
+        client = await self.connect()
+        results = await client.executeCommands(["defint x 1", "add x 2", "print %x%", "define y hello", "add y !", "print %y% %x%"])
+        self.assertEqual(results, [("ok", ""), ("ok", ""), ("ok", "3\n"), ("ok", ""), ("ok", ""), ("ok", "hello!\n3\n")])
+
+    async def test_sessionsAreIsolated(self):
+        first = await self.connect()
+        second = await self.connect()
+        await first.executeCommand("define x first")
+        self.assertEqual(await second.executeCommand("print %x%"), ("ok", "%x%\n"))
+        self.assertEqual(await first.executeCommand("print %x%"), ("ok", "first\n"))
+        self.assertEqual(len(JUtils2.storedVariables), 0)
+
+    async def test_pooledSessionIsReset(self):
+        first = await self.connect()
+        await first.executeCommand("define x first")
+        await first.close()
+        while len(self.server.sessions.idle) == 0:
+            await asyncio.sleep(0.01)
+        session = self.server.sessions.idle[-1]
+
+        second = await self.connect()
+        self.assertEqual(await second.executeCommand("print %x%"), ("ok", "%x%\n"))
+        self.assertNotIn(session, self.server.sessions.idle)
+
+    async def test_errorStatus(self):
+        client = await self.connect()
+        results = await client.executeCommands(["print \"unclosed", "conditional missing 1 \"print a\"", "print ok"])
+        self.assertEqual([x[0] for x in results], ["error", "error", "ok"])
+        self.assertIn("No closing quotation", results[0][1])
+        self.assertIn("KeyError", results[1][1])
+
+    async def test_lineLimit(self):
+        client = await self.connect()
+        results = await client.executeCommands(["print a", "print " + "a" * 8192, "print b"])
+        self.assertEqual(results[0], ("ok", "a\n"))
+        self.assertEqual(results[1][0], "error")
+        self.assertEqual(results[2], ("closed", ""))
+        self.assertTrue(client.isClosed())
+
+    async def test_responseLimit(self):
+        server = await JUtils2.CommandServer(responseLimit = 4096).start()
+        try:
+            client = await JUtils2.CommandClient.connect(*server.getAddress()[:2])
+            self.clients.append(client)
+            results = await client.executeCommands(["define x " + "é" * 2000, "print first", "print %x% %x% %x%", "print third"])
+            self.assertEqual(results[1], ("ok", "first\n"))
+            self.assertEqual(results[2][0], "error")
+            self.assertEqual(results[3], ("ok", "third\n"))
+            self.assertEqual(await client.executeCommand("print fourth"), ("ok", "fourth\n"))
+        finally:
+            await server.close()
+
+    async def test_clientResponseLimit(self):
+        client = await JUtils2.CommandClient.connect(self.host, self.port, responseLimit = 1024)
+        self.clients.append(client)
+        results = await client.executeCommands(["print first", "print " + "é " * 1000, "print third"])
+        self.assertEqual(results[0], ("ok", "first\n"))
+        self.assertEqual(results[1][0], "error")
+        self.assertEqual(results[2], ("closed", ""))
+        self.assertTrue(client.isClosed())
+
+    async def test_exitClosesConnection(self):
+        client = await self.connect()
+        self.assertEqual(await client.executeCommands(["print a", "exit", "print b"]), [("ok", "a\n"), ("exit", ""), ("closed", "")])
+        self.assertTrue(client.isClosed())
+        self.assertEqual(await client.executeCommands(["exit"]), [("closed", "")])
+        self.assertEqual(await client.executeCommand("print c"), ("closed", ""))
+
+    async def test_abandonedRequestClosesClient(self):
+        server = await JUtils2.CommandServer(requestTimeLimit = 0.2).start()
+        try:
+            client = await JUtils2.CommandClient.connect(*server.getAddress()[:2])
+            self.clients.append(client)
+            self.assertEqual((await client.executeCommand("wait 2000"))[0], "timeout")
+            self.assertTrue(client.isClosed())
+        finally:
+            await server.close()
+
+    async def test_closeWithConnectedClients(self):
+        first = await self.connect()
+        second = await self.connect()
+        await first.executeCommand("print a")
+        await second.executeCommand("print b")
+        await asyncio.wait_for(self.server.close(), 5)
+        self.assertEqual(await first.executeCommand("print c"), ("closed", ""))
+        self.assertEqual(len(self.server.connections), 0)
+
+    async def test_cancelledConnectionAbandonsRunningSession(self):
+        client = await self.connect()
+        request = asyncio.create_task(client.executeCommand("wait 500"))
+        await asyncio.sleep(0.1)
+        connections = list(self.server.connections.keys())
+        for connection in connections:
+            connection.cancel()
+        await asyncio.gather(*connections, return_exceptions = True)
+        self.assertEqual(await request, ("closed", ""))
+        self.assertEqual(len(self.server.sessions.idle), 0)
+
+    async def test_commandFactoryCreatesCommandsPerSession(self):
+        server = await JUtils2.CommandServer(lambda processor: [ProcessorCommand(processor)]).start()
+        try:
+            first = await JUtils2.CommandClient.connect(*server.getAddress()[:2])
+            second = await JUtils2.CommandClient.connect(*server.getAddress()[:2])
+            self.clients += [first, second]
+            firstResults = await first.executeCommands(["processor", "processor"])
+            secondResult = await second.executeCommand("processor")
+            self.assertEqual(firstResults[0], firstResults[1])
+            self.assertEqual(firstResults[0][0], "ok")
+            self.assertNotEqual(firstResults[0], secondResult)
+        finally:
+            await server.close()
+
+    async def test_largeBatchDoesNotDeadlock(self):
+        # Unix sockets have small buffers, so a few megabytes of requests and responses fills them in both directions.
+        path = os.path.join(self.directory.name, "server.sock")
+        server = await JUtils2.CommandServer().start(path = path)
+        try:
+            client = await self.connect(path)
+            results = await asyncio.wait_for(client.executeCommands(["print " + "a" * 400] * 5000), 30)
+            self.assertEqual(len(results), 5000)
+            self.assertEqual(results[-1], ("ok", "a" * 400 + "\n"))
+        finally:
+            await server.close()
+
+    async def test_slowRequestDoesNotBlockOtherConnections(self):
+        slow = await self.connect()
+        fast = await self.connect()
+        slowRequest = asyncio.create_task(slow.executeCommand("wait 1000"))
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        self.assertEqual(await fast.executeCommand("print hi"), ("ok", "hi\n"))
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(await slowRequest, ("ok", ""))
+
+    async def test_waitingForWorkerDoesNotCountTowardsTimeLimit(self):
+        server = await JUtils2.CommandServer(maximumWorkers = 1, requestTimeLimit = 1).start()
+        try:
+            clients = []
+            for x in range(0, 3):
+                clients.append(await JUtils2.CommandClient.connect(*server.getAddress()[:2]))
+            self.clients += clients
+            slowRequests = [asyncio.create_task(clients[0].executeCommand("wait 1200")), asyncio.create_task(clients[1].executeCommand("wait 1200"))]
+            await asyncio.sleep(0.1)
+            self.assertEqual(await clients[2].executeCommand("print hi"), ("ok", "hi\n"))
+            self.assertEqual(await asyncio.gather(*slowRequests), [("ok", ""), ("ok", "")])
+        finally:
+            await server.close()
+
+    async def test_loopingScriptTimesOut(self):
+        script = os.path.join(self.directory.name, "loop.txt")
+        with open(script, "w") as fileWrite:
+            fileWrite.write(f"run \"{script}\"\n")
+        client = await self.connect()
+        results = await client.executeCommands([f"run \"{script}\"", "print done"])
+        self.assertEqual(results[0][0], "timeout")
+        self.assertEqual(results[1], ("ok", "done\n"))
+
+class CommandClientPoolTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = await JUtils2.CommandServer().start()
+        self.host, self.port = self.server.getAddress()[:2]
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def test_connectionsAreReused(self):
+        pool = JUtils2.CommandClientPool(self.host, self.port, maximumConnections = 2)
+        try:
+            self.assertEqual(await pool.executeCommands(["define x pooled", "print %x%"]), [("ok", ""), ("ok", "pooled\n")])
+            client = pool.idle[-1]
+            self.assertEqual(await pool.executeCommand("print %x%"), ("ok", "pooled\n"))
+            self.assertEqual(pool.idle, [client])
+            self.assertEqual(len(self.server.connections), 1)
+        finally:
+            await pool.close()
+
+    async def test_closedConnectionsAreDropped(self):
+        pool = JUtils2.CommandClientPool(self.host, self.port, maximumConnections = 2)
+        try:
+            await pool.executeCommand("define x first")
+            client = pool.idle[-1]
+            self.assertEqual(await pool.executeCommands(["exit", "print a"]), [("exit", ""), ("closed", "")])
+            self.assertEqual(pool.idle, [])
+            self.assertEqual(await pool.executeCommand("print %x%"), ("ok", "%x%\n"))
+            self.assertNotIn(client, pool.idle)
+        finally:
+            await pool.close()
+
+    async def test_benchmarkServer(self):
+        self.assertGreater(await JUtils2.benchmarkServer(self.host, self.port, requests = 500, connections = 4, pipelineDepth = 16), 0)
+        self.assertGreaterEqual(self.server.requestsServed, 500)
+
+class RunServerTest(unittest.IsolatedAsyncioTestCase):
+    @unittest.skipIf(sys.platform == "win32", "Unix sockets are not available.")
+    async def test_runServerServesUntilInterrupted(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "server.sock")
+            process = await asyncio.create_subprocess_exec(sys.executable, "-u", "-c", f"import JUtils2; JUtils2.runServer(path = {path!r})", cwd = os.path.dirname(os.path.abspath(JUtils2.__file__)), stdout = asyncio.subprocess.PIPE)
+            try:
+                self.assertIn("Serving on", (await asyncio.wait_for(process.stdout.readline(), 10)).decode())
+                client = await JUtils2.CommandClient.connect(path = path)
+                self.assertEqual(await client.executeCommand("print hi"), ("ok", "hi\n"))
+                await client.close()
+                process.send_signal(signal.SIGINT)
+                self.assertEqual(await asyncio.wait_for(process.wait(), 10), 0)
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+if __name__ == "__main__":
+    unittest.main()